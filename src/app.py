@@ -1,49 +1,41 @@
 import streamlit as st
 from uuid import uuid4
 from config import model
-from memory_manager import SimpleMemoryManager
+from memory_manager import SimpleMemoryManager, load_embedder
 from encoder_decoder import encode_text_local, decode_text_local
 
 st.set_page_config(page_title="🧠 Dynamic Encoded Memory", layout="wide")
-@st.cache_data
-def estimate_tokens(history):
-    return len(" ".join([f"{msg['role']}: {''.join([p['text'] for p in msg['parts']])}" for msg in history]).split())
-def run_lzma_test():
-    with st.sidebar.expander("🔐 LZMA Test"):
+def run_zstd_test():
+    with st.sidebar.expander("🔐 zstd Test"):
         sample_text = "The quick brown fox jumps over the lazy dog. This is a test for reversible encoding."
         if st.button("Run Test"):
             encoded = encode_text_local(sample_text, "sample_chunk")
             decoded = decode_text_local(encoded['encoded_data'])
             st.success("✅ Perfect match!" if decoded.strip() == sample_text.strip() else "⚠️ Check output.")
-            st.text(f"Encoded (first 120): {encoded['encoded_data'][:120]}...")
+            st.text(f"Encoded ({len(encoded['encoded_data'])} bytes, first 60 hex): {encoded['encoded_data'][:60].hex()}...")
+
+@st.cache_resource
+def get_embedder():
+    # One model per server process, shared by every session (None without the embedding stack)
+    return load_embedder()
 
 @st.cache_resource
 def get_manager():
-    return SimpleMemoryManager(token_limit=8000, enable_history=True)
+    return SimpleMemoryManager(token_limit=8000, enable_history=True, embedder=get_embedder())
 
-def main():
-    st.title("🧠 Dynamic Encoded Memory Demo")
-    st.markdown("Gemini + LZMA for infinite context. Chat, recall semantically, watch metrics!")
-    
-    if 'manager' not in st.session_state:
-        st.session_state.manager = get_manager()
-    
-    manager = st.session_state.manager
-    
-    # Sidebar: History + Controls
-    st.sidebar.title("📚 Chat History")
+@st.fragment
+def sidebar_sessions(manager: SimpleMemoryManager):
+    """Session list; reruns on its own, full app rerun only when the active chat or the list changes."""
+    st.title("📚 Chat History")
     sessions = manager.get_sessions()
     if sessions:
         for session in sessions:
             col1, col2 = st.columns([4, 1])
             with col1:
                 # Clickable title: Button styled as link
-                if st.button(f"**{session['title']}** ({session['updated'].strftime('%m/%d %H:%M')} | {manager.get_stored_tokens_for_session(session['id'])} tokens)", key=f"click_{session['id']}", help="Click to resume/open"):
+                if st.button(f"**{session['title']}** ({session['updated'].strftime('%m/%d %H:%M')} | {session['tokens']} tokens)", key=f"click_{session['id']}", help="Click to resume/open"):
                     st.session_state.chat_id = session['id']
-                    manager.set_chat_id(st.session_state.chat_id)
-                    # Rebuild cache
-                    raw_stored = manager._get_stored_raw(st.session_state.chat_id)
-                    manager.stored_texts = [(session['id'], text) for _, text in raw_stored]
+                    manager.set_chat_id(st.session_state.chat_id)  # Memories load lazily on first recall
                     # Reset history for resume
                     st.session_state.history = [{"role": "user", "parts": [{"text": f"Resuming session: {session['title']}. Continue from prior context."}]}]
                     st.rerun()
@@ -54,23 +46,19 @@ def main():
                     else:
                         manager.delete_session(session['id'])
                         st.rerun()
-            st.sidebar.caption(session['preview'])
+            st.caption(session['preview'])
     else:
-        st.sidebar.info("No past chats. Start one!")
+        st.info("No past chats. Start one!")
     
-    if st.sidebar.button("New Chat"):
+    if st.button("New Chat"):
         st.session_state.chat_id = manager.create_session("New Chat")
         manager.set_chat_id(st.session_state.chat_id)
         st.session_state.history = [{"role": "user", "parts": [{"text": "You are a helpful AI assistant. Keep responses concise but informative."}]}]
         st.rerun()
-    
-    # Current chat setup
-    if 'chat_id' not in st.session_state:
-        st.session_state.chat_id = manager.create_session("New Chat")
-        manager.set_chat_id(st.session_state.chat_id)
-        st.session_state.history = [{"role": "user", "parts": [{"text": "You are a helpful AI assistant. Keep responses concise but informative."}]}]
-    
-    chat_id = st.session_state.chat_id
+
+@st.fragment
+def chat_area(manager: SimpleMemoryManager):
+    """History render + input; a new message reruns only this fragment unless it changed the session row."""
     history = st.session_state.history
     
     # Chat interface
@@ -85,49 +73,59 @@ def main():
         
         # Semantic recall
         recall_injected = ""
-        if prompt.lower().startswith('recall '):
+        if prompt[:7].lower() == 'recall ':  # Lowercase only the prefix, not the whole prompt
             query = prompt[7:].strip()
             relevant = manager.find_relevant(query)
             if relevant:
                 recall_injected = "\n".join(relevant)
-                history[0]['parts'][0]['text'] += f"\nRelevant prior context: {recall_injected}"
+                # Appended as a new part: O(new text), the system prompt string is never rebuilt
+                history[0]['parts'].append({"text": f"\nRelevant prior context: {recall_injected}"})
+                manager.register_user_turn(recall_injected)
                 st.chat_message("system").write(f"🔍 Recalled: {recall_injected[:200]}...")
             prompt = f"Recall query was '{query}', but continue conversation."
         
-        # Token est.
-        current_prompt = "\n".join([f"{msg['role']}: {''.join([p['text'] for p in msg['parts']])}" for msg in history])
-        current_tokens = len(current_prompt.split())
-        
-        # Reabsorb
-        if manager.should_reabsorb(current_tokens):
-            reabsorbed = manager.reabsorb_oldest()
+        # Reabsorb (token est. kept incrementally by the manager)
+        reabsorbed = ""
+        if manager.should_reabsorb(manager.current_tokens):
+            reabsorbed = manager.reabsorb_oldest(manager.reabsorb_batch)
             if reabsorbed:
-                history[0]['parts'][0]['text'] += f"\nReabsorbed prior context: {reabsorbed}"
+                history[0]['parts'].append({"text": f"\nReabsorbed prior context: {reabsorbed}"})
+                manager.register_user_turn(reabsorbed)
                 st.chat_message("system").write("📜 Context reabsorbed!")
         
         # Gemini
         history.append({"role": "user", "parts": [{"text": prompt}]})
+        manager.register_user_turn(prompt)
         try:
             response = model.generate_content(history)
             assistant_text = response.text
+            usage = response.usage_metadata
         except Exception as e:
             assistant_text = f"Error: {e}"
+            usage = None
+        manager.register_model_turn(assistant_text, usage)  # Exact prompt + reply tokens from the response
         
         # Store with first_prompt for auto-title
         title = f"Turn {len(history)//2}: {prompt[:20]}..."
-        manager.store_response(assistant_text, title, prompt)
+        stored = manager.store_response(assistant_text, title, prompt)
         
-        # Update & display
+        # Update & display (rendered in place; the next fragment run picks them up from history)
         history.append({"role": "model", "parts": [{"text": assistant_text}]})
         st.chat_message("user").write(prompt)
         st.chat_message("assistant").write(assistant_text)
-        st.rerun()
-    
-    # Sidebar Metrics
-    with st.sidebar.expander("📊 Metrics"):
+        
+        # Title, preview or token total of the session row changed: refresh the session list too
+        if stored or reabsorbed:
+            st.rerun(scope="app")
+
+@st.fragment(run_every=5)
+def sidebar_metrics(manager: SimpleMemoryManager):
+    """Metrics panel; refreshes on its own timer so skips and recalls show without an app rerun."""
+    with st.expander("📊 Metrics"):
         total_tokens = manager.get_stored_tokens()
         expansion = total_tokens / manager.token_limit if total_tokens else 1
-        skips = manager.metrics['skipped_short'] + manager.metrics['skipped_low_grade']
+        skips = (manager.metrics['skipped_short'] + manager.metrics['skipped_low_grade']
+                 + manager.metrics['skipped_dup'] + manager.metrics['skipped_incompressible'])
         st.json({
             'Stores': manager.metrics['stores'],
             'Skips': skips,
@@ -138,12 +136,37 @@ def main():
         })
         if st.button("Summary & Chart"):
             manager.print_summary()
+
+def main():
+    st.title("🧠 Dynamic Encoded Memory Demo")
+    st.markdown("Gemini + zstd for infinite context. Chat, recall semantically, watch metrics!")
+    
+    if 'manager' not in st.session_state:
+        st.session_state.manager = get_manager()
+    
+    manager = st.session_state.manager
+    
+    # Sidebar: History + Controls
+    with st.sidebar:
+        sidebar_sessions(manager)
+    
+    # Current chat setup
+    if 'chat_id' not in st.session_state:
+        st.session_state.chat_id = manager.create_session("New Chat")
+        manager.set_chat_id(st.session_state.chat_id)
+        st.session_state.history = [{"role": "user", "parts": [{"text": "You are a helpful AI assistant. Keep responses concise but informative."}]}]
+    
+    chat_area(manager)
+    
+    # Sidebar Metrics
+    with st.sidebar:
+        sidebar_metrics(manager)
     
     if st.sidebar.button("End Chat & Viz"):
         manager.print_summary()
         st.balloons()
     
-    run_lzma_test()
+    run_zstd_test()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -12,45 +12,48 @@ def chat_with_memory(manager: SimpleMemoryManager):
     manager.set_chat_id(chat_id)
     
     conversation_history = [{"role": "user", "parts": [{"text": "You are a helpful AI assistant. Keep responses concise but informative."}]}]
-    print(f"🤖 New Chat Session: {chat_id[:8]}... | Gemini Boss LLM + LZMA Memory Demo (type 'exit' to quit)\n")
+    print(f"🤖 New Chat Session: {chat_id[:8]}... | Gemini Boss LLM + zstd Memory Demo (type 'exit' to quit)\n")
     print("💡 Tip: Say 'recall [topic]' to pull relevant memories semantically!\n")
     
     while True:
         user_input = input("You: ").strip()
-        if user_input.lower() == 'exit':
+        if len(user_input) == 4 and user_input.lower() == 'exit':
             manager.print_summary()
             break
         
         # Semantic recall trigger
         recall_injected = ""
-        if user_input.lower().startswith('recall '):
+        if user_input[:7].lower() == 'recall ':  # Lowercase only the prefix, not the whole input
             query = user_input[7:].strip()  # "recall ethics" -> "ethics"
             relevant = manager.find_relevant(query)
             if relevant:
                 recall_injected = "\n".join(relevant)
-                conversation_history[0]['parts'][0]['text'] += f"\nRelevant prior context: {recall_injected}"
+                # Appended as a new part: O(new text), the system prompt string is never rebuilt
+                conversation_history[0]['parts'].append({"text": f"\nRelevant prior context: {recall_injected}"})
+                manager.register_user_turn(recall_injected)
                 print(f"🔍 Recalled {len(relevant)} relevant items: '{recall_injected[:100]}...'")
             user_input = f"Recall query was '{query}', but continue conversation."  # Fallback prompt
         
-        # Est. current tokens
-        current_prompt = "\n".join([f"{msg['role']}: {''.join([p['text'] for p in msg['parts']])}" for msg in conversation_history])
-        current_tokens = len(current_prompt.split())
-        
-        # Interval/usage-based reabsorb (isolated to chat_id)
-        if manager.should_reabsorb(current_tokens):
-            reabsorbed = manager.reabsorb_oldest()
+        # Interval/usage-based reabsorb (isolated to chat_id; token est. kept incrementally by the manager)
+        if manager.should_reabsorb(manager.current_tokens):
+            reabsorbed = manager.reabsorb_oldest(manager.reabsorb_batch)
             if reabsorbed:
-                conversation_history[0]['parts'][0]['text'] += f"\nReabsorbed prior context: {reabsorbed}"
+                conversation_history[0]['parts'].append({"text": f"\nReabsorbed prior context: {reabsorbed}"})
+                manager.register_user_turn(reabsorbed)
                 print("📜 Context reabsorbed (interval/usage trigger)!")
         
         # Gemini call
         conversation_history.append({"role": "user", "parts": [{"text": user_input}]})
+        manager.register_user_turn(user_input)
         try:
             response = model.generate_content(conversation_history)
             assistant_text = response.text
+            usage = response.usage_metadata
         except Exception as e:
             assistant_text = f"Error: {e}"
             logging.warning(f"Gemini API error: {e}")
+            usage = None
+        manager.register_model_turn(assistant_text, usage)  # Exact prompt + reply tokens from the response
         
         # Store (filtered + logged)
         title = f"Turn {len(conversation_history)//2}: {user_input[:20]}..."
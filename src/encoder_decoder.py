@@ -1,24 +1,168 @@
+import io
 import lzma
 import base64
-from typing import Dict
+import logging
+import threading
+from typing import Dict, List, Optional, Union
+import zstandard as zstd
 
-def encode_text_local(text: str, title: str) -> Dict[str, str]:
+ZSTD_LEVEL = 6
+DICT_SIZE = 100_000
+RETRAIN_EVERY = 64   # New samples required before the shared dictionary is retrained
+MAX_SAMPLES = 1024   # Most recent chat turns kept as training material
+MIN_RETRAIN_GAIN = 0.05  # A retrain must shrink the samples by 5% over the active dictionary, else training stops
+STREAM_THRESHOLD = 16_384       # Larger payloads are fed to zstd in chunks
+STREAM_CHUNK = 64 * 1024
+THREADED_THRESHOLD = 1 << 20    # From 1 MiB, compress with zstd worker threads
+
+logger = logging.getLogger(__name__)
+
+# Process-wide codec state: dictionaries are digested once and shared; each thread keeps
+# its own compressor/decompressors (zstd contexts are not thread-safe), reused across calls
+# so codecs never serialize behind a lock. _lock only guards the registry and samples.
+_lock = threading.Lock()
+_local = threading.local()
+_active_dict: Optional[zstd.ZstdCompressionDict] = None
+_dicts: Dict[int, zstd.ZstdCompressionDict] = {}
+_samples: List[bytes] = []
+_new_samples = 0
+_training = False
+_converged = False  # Set once a retrain stops paying off; no further samples are collected
+
+def register_dictionary(dict_data: bytes, activate: bool = True) -> int:
+    """
+    Load a trained zstd dictionary; activate makes it the one used for compression.
+    Every registered dictionary stays available to the decoder.
+    """
+    global _active_dict
+    zdict = zstd.ZstdCompressionDict(dict_data)
+    zdict.precompute_compress(level=ZSTD_LEVEL)  # Digested once, shared by every thread's compressor
+    dict_id = zdict.dict_id()
+    with _lock:
+        _dicts[dict_id] = zdict
+        if activate:
+            _active_dict = zdict
+    return dict_id
+
+def has_dictionary(dict_id: int) -> bool:
+    return dict_id == 0 or dict_id in _dicts
+
+def get_dictionary(dict_id: int) -> Optional[bytes]:
+    """Raw bytes of a registered dictionary, for persisting next to the frames that use it."""
+    zdict = _dicts.get(dict_id)
+    return zdict.as_bytes() if zdict is not None else None
+
+def frame_dictionary_id(encoded_data: bytes) -> int:
+    """Dictionary id recorded in a frame header (0 = no dictionary)."""
+    try:
+        return zstd.get_frame_parameters(encoded_data).dict_id
+    except Exception as e:
+        raise ValueError(f"Invalid zstd frame: {e}")
+
+def _compressed_size(zdict: zstd.ZstdCompressionDict, samples: List[bytes]) -> int:
+    compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+    return sum(len(compressor.compress(s)) for s in samples)
+
+def _retrain_dictionary(samples: List[bytes]):
+    global _training, _converged
+    try:
+        total = sum(len(s) for s in samples)
+        dict_size = min(DICT_SIZE, total // 10)
+        if dict_size < 1024:
+            return
+        zdict = zstd.train_dictionary(dict_size, samples)
+        current = _active_dict
+        if current is not None:
+            gain = 1 - _compressed_size(zdict, samples) / _compressed_size(current, samples)
+            if gain < MIN_RETRAIN_GAIN:
+                _converged = True
+                logger.info(f"zstd dictionary {current.dict_id()} is good enough (retrain gain {gain:.1%}), retraining stopped", extra={'chat_id': 'GLOBAL'})
+                return
+        # Not persisted here: the store saves a dictionary with the first row that references it
+        dict_id = register_dictionary(zdict.as_bytes())
+        logger.info(f"Trained zstd dictionary {dict_id} ({len(zdict.as_bytes())} bytes) from {len(samples)} samples", extra={'chat_id': 'GLOBAL'})
+    except Exception as e:
+        logger.warning(f"zstd dictionary training failed: {e}", extra={'chat_id': 'GLOBAL'})
+    finally:
+        _training = False
+
+def _record_sample(data: bytes):
+    """Keep recent turns as training samples; retrain in a background thread every RETRAIN_EVERY samples. Caller holds _lock."""
+    global _new_samples, _training
+    if _converged:
+        return
+    _samples.append(data)
+    if len(_samples) > MAX_SAMPLES:
+        del _samples[:len(_samples) - MAX_SAMPLES]
+    _new_samples += 1
+    if _new_samples >= RETRAIN_EVERY and not _training:
+        _new_samples = 0
+        _training = True
+        threading.Thread(target=_retrain_dictionary, args=(list(_samples),), daemon=True).start()
+
+def _thread_compressor() -> zstd.ZstdCompressor:
+    """This thread's compressor for the active dictionary; rebuilt only after a retrain."""
+    zdict = _active_dict
+    if getattr(_local, 'compressor', None) is None or _local.compressor_dict is not zdict:
+        _local.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+        _local.compressor_dict = zdict
+    return _local.compressor
+
+def _thread_decompressor(dict_id: int) -> zstd.ZstdDecompressor:
+    decompressors = getattr(_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _local.decompressors = {}
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        zdict = _dicts.get(dict_id)
+        if dict_id and zdict is None:
+            raise ValueError(f"unknown zstd dictionary {dict_id}")
+        decompressor = decompressors[dict_id] = zstd.ZstdDecompressor(dict_data=zdict)
+    return decompressor
+
+def _compress_stream(compressor: zstd.ZstdCompressor, data: bytes) -> bytes:
+    """Feed data in STREAM_CHUNK slices; each write releases the GIL instead of one long call."""
+    out = io.BytesIO()
+    with compressor.stream_writer(out, size=len(data), closefd=False) as writer:
+        view = memoryview(data)
+        for start in range(0, len(data), STREAM_CHUNK):
+            writer.write(view[start:start + STREAM_CHUNK])
+    return out.getvalue()
+
+def encode_text_local(text: str, title: str) -> Dict[str, Union[str, bytes]]:
+    """
+    Lossless, deterministic encoding: zstd compress (shared dictionary) -> raw bytes.
+    Returns a dict with title and encoded_data, ready for a SQLite BLOB column.
+    Frames carry their dictionary id, so decoding survives later retrains.
+    Long replies are streamed in chunks (multi-threaded from 1 MiB); the frame format is the same.
+    """
+    data = text.encode("utf-8")
+    if len(data) >= THREADED_THRESHOLD:
+        compressed = _compress_stream(zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_active_dict, threads=-1), data)
+    elif len(data) > STREAM_THRESHOLD:
+        compressed = _compress_stream(_thread_compressor(), data)
+    else:
+        compressed = _thread_compressor().compress(data)
+    with _lock:
+        _record_sample(data[:STREAM_THRESHOLD])  # The dictionary targets short turns
+    return {"title": title, "encoded_data": compressed}
+
+def decode_text_local(encoded_data: bytes) -> str:
     """
-    Lossless, deterministic encoding: lzma compress -> base64 encode.
-    Returns a dict with title and encoded_data.
-    Tunable preset=6 balances speed/ratio; crank to 9 for max compression.
+    zstd decompress (dictionary picked from the frame header) -> original string.
     """
-    compressed = lzma.compress(text.encode("utf-8"), preset=6)
-    b64 = base64.b64encode(compressed).decode("ascii")
-    return {"title": title, "encoded_data": b64}
+    try:
+        dict_id = zstd.get_frame_parameters(encoded_data).dict_id
+        return _thread_decompressor(dict_id).decompress(encoded_data).decode("utf-8")
+    except Exception as e:
+        raise ValueError(f"Decompression failed: {e}")
 
-def decode_text_local(encoded_data: str) -> str:
+def decode_legacy_text(encoded_data: str) -> str:
     """
-    Decode base64 -> lzma decompress -> original string.
+    Decode a pre-zstd row (base64 text of an LZMA stream). Only used to migrate old databases.
     """
     try:
         compressed = base64.b64decode(encoded_data.encode("ascii"))
-        text = lzma.decompress(compressed).decode("utf-8")
-        return text
+        return lzma.decompress(compressed).decode("utf-8")
     except Exception as e:
-        raise ValueError(f"Decompression failed: {e}")
\ No newline at end of file
+        raise ValueError(f"Legacy decompression failed: {e}")
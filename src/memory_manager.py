@@ -1,119 +1,363 @@
+import os
+import time
+import queue
+import atexit
+import importlib.util
 import sqlite3
 import logging
+import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, List
+from typing import TYPE_CHECKING, Optional, List
 from uuid import uuid4
-from encoder_decoder import encode_text_local, decode_text_local
+import xxhash
+from encoder_decoder import (encode_text_local, decode_text_local, decode_legacy_text, register_dictionary,
+                             has_dictionary, get_dictionary, frame_dictionary_id)
 from config import model
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import matplotlib.pyplot as plt
+# numpy/scipy/sklearn/matplotlib (and torch via sentence-transformers, numpy via sqlite-vec) are
+# imported where they are used, so a fresh Streamlit worker only pays for the ones a request touches
+if TYPE_CHECKING:
+    import numpy as np
+    import scipy.sparse as sp
+# Offline/minimal install: hashed-term recall only
+HAS_SQLITE_VEC = importlib.util.find_spec('sqlite_vec') is not None
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec('sentence_transformers') is not None
 
 DB_PATH = 'hack_memory.db'
+EMBED_MODEL = 'all-MiniLM-L6-v2'
+EMBED_DIM = 384
+RERANK_CANDIDATES = 50  # Hamming hits re-scored with exact FP32 cosine
+FLUSH_INTERVAL = 0.1  # Seconds a write batch may wait for more items
+FLUSH_BATCH = 64
+REABSORB_BATCH = 4  # Oldest memories evicted at once when the prompt nears token_limit
+WRITE_RETRIES = 5  # Attempts per batch when the DB stays locked past the busy timeout
+DECODED_CACHE_SIZE = 16  # Recently resumed chats kept decoded in memory
+RECALL_WINDOW = 200  # Most recent memories decoded for the hashed-term fallback
+DEDUP_WINDOW = 64  # Recent stored replies per chat checked for exact repeats
+MIN_COMPRESSION_GAIN = 0.9  # Skip storing when zstd keeps more than this share of the bytes
 
 # Setup logging
+class _DefaultChatId(logging.Filter):
+    """Fill chat_id on records from other libraries (e.g. sentence-transformers) so the format resolves."""
+    def filter(self, record):
+        if not hasattr(record, 'chat_id'):
+            record.chat_id = '-'
+        return True
+
+_log_handlers = [logging.FileHandler('hack_memory.log', mode='a'), logging.StreamHandler()]
+for _handler in _log_handlers:
+    _handler.addFilter(_DefaultChatId())
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - Chat %(chat_id)s - %(message)s',
-    handlers=[
-        logging.FileHandler('hack_memory.log', mode='a'),
-        logging.StreamHandler()
-    ]
+    handlers=_log_handlers
 )
 logger = logging.getLogger(__name__)
 
+def load_embedder():
+    """Load the sentence-embedding model, or None when the embedding stack is unavailable."""
+    if not HAS_SENTENCE_TRANSFORMERS:
+        return None
+    try:
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(EMBED_MODEL)
+    except Exception as e:
+        logger.warning(f"Embedding model unavailable ({e}), using hashed-term recall", extra={'chat_id': 'GLOBAL'})
+        return None
+
+# Charts render on one background thread that owns a single reused Figure
+_chart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metrics-chart')
+_chart_fig = None
+
+def _render_chart(chat_id: str, labels: List[str], values: List[float], chart_path: str):
+    global _chart_fig
+    try:
+        if _chart_fig is None:
+            import matplotlib
+            matplotlib.use('Agg')  # Non-interactive: charts are only written to PNG
+            from matplotlib.figure import Figure
+            _chart_fig = Figure(figsize=(8, 5))
+            _chart_fig.add_subplot()
+        ax = _chart_fig.axes[0]
+        ax.clear()
+        ax.bar(labels, values, color=['blue', 'orange', 'green', 'purple', 'red'])
+        ax.set_title(f"Chat {chat_id[:8]}... Impact")
+        ax.set_ylabel('Value')
+        ax.tick_params(axis='x', labelrotation=45)
+        _chart_fig.savefig(chart_path)
+        logger.info(f"Metrics chart saved to {chart_path}", extra={'chat_id': chat_id})
+    except Exception as e:
+        logger.warning(f"Metrics chart failed: {e}", extra={'chat_id': chat_id})
+
+def _top_k(sims: 'np.ndarray', top_k: int, min_sim: float) -> 'np.ndarray':
+    """Indices of the top_k scores >= min_sim, best first. argpartition keeps it O(N); only k survivors get sorted."""
+    import numpy as np
+    idx = np.flatnonzero(sims >= min_sim)
+    if len(idx) > top_k:
+        idx = idx[np.argpartition(sims[idx], -top_k)[-top_k:]]
+    return idx[np.argsort(-sims[idx])]
+
 class SimpleMemoryManager:
-    """Lightweight SQLite store using LZMA encoder. Per-chat isolation + thresholds + grader + semantic recall + history."""
+    """Lightweight SQLite store using zstd encoder. Per-chat isolation + thresholds + grader + semantic recall + history."""
     def __init__(self, db_path: str = DB_PATH, token_limit: int = 8000, 
                  min_tokens_threshold: int = 50,
                  grade_threshold: int = 6,
                  use_grader: bool = False,
                  reabsorb_interval: int = 3,
-                 enable_history: bool = True):
+                 enable_history: bool = True,
+                 embedder=None):
         self.db_path = db_path
         self.token_limit = token_limit
         self.min_tokens_threshold = min_tokens_threshold
         self.grade_threshold = grade_threshold
         self.use_grader = use_grader
         self.reabsorb_interval = reabsorb_interval
+        self.reabsorb_batch = 1  # Set by should_reabsorb for the following reabsorb_oldest call
         self.turn_counter = 0
         self.chat_id = 'GLOBAL'
         self.enable_history = enable_history
         self.first_prompt = None  # For auto-title
+        self._counted_tokens: int = 0  # Prompt size in Gemini tokens as of the last count/response
+        self._uncounted: List[str] = []  # Text added to the prompt since then, counted in one call on demand
         self.metrics = {'stores': 0, 'skipped_short': 0, 'skipped_low_grade': 0, 
                         'reabsorbs': 0, 'evictions': 0, 'total_compressed_chars': 0,
-                        'semantic_recalls': 0}
-        self.stored_texts = []
-        self.vectorizer = TfidfVectorizer(max_features=100)
+                        'semantic_recalls': 0, 'skipped_dup': 0, 'skipped_incompressible': 0}
+        self._seen_hashes: defaultdict = defaultdict(lambda: deque(maxlen=DEDUP_WINDOW))  # chat_id -> recent xxh3 digests
+        self._decoded_cache: OrderedDict = OrderedDict()  # chat_id -> {memory id: decoded text}, LRU
+        # Stateless hashing: no fit, so each text is vectorized once and rows are appended
+        self._vectorizer = None  # Built on first hashed-term use, see the vectorizer property
+        self.doc_matrix: Optional['sp.csr_matrix'] = None  # Row i vectorizes memory doc_ids[i]
+        self.doc_ids: List[int] = []
+        self._doc_matrix_dirty = False  # Saved to disk on chat switch / close, not per store
+        self.vectors_dir = os.path.splitext(db_path)[0] + '_vectors'
+        # Sentence embeddings + sqlite-vec index when available; hashed terms above are the fallback.
+        # Pass a shared embedder (e.g. from st.cache_resource) to skip the per-manager model load.
+        self.use_embeddings = HAS_SQLITE_VEC and (embedder is not None or HAS_SENTENCE_TRANSFORMERS)
+        self.embedder = embedder
+        self._embedded_chats: set = set()  # Chats whose rows all have embeddings (checked once per manager)
+        # Streamlit serves sessions from several threads; re-entrant so a decode inside a
+        # transaction can still load a missing dictionary
+        self._lock = threading.RLock()
+        self.conn = self._open_connection()
         self._init_db()
+        self._write_q: queue.Queue = queue.Queue()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.close)
         logger.info("MemoryManager initialized", extra={'chat_id': self.chat_id})
     
     def set_chat_id(self, chat_id: str):
+        self._save_doc_matrix()  # Persist the outgoing chat's vectors
         self.chat_id = chat_id
         self.turn_counter = 0  # Reset for new session
-        self.stored_texts = []  # Clear cache; rebuild on load
+        self._counted_tokens = 0
+        self._uncounted = []
+        self.doc_matrix, self.doc_ids = self._load_doc_matrix(chat_id)
+        self._doc_matrix_dirty = False
         if self.enable_history:
             self.create_session("New Chat")  # Ensure entry
         logger.info(f"Switched to chat session: {chat_id}", extra={'chat_id': self.chat_id})
     
+    def _open_connection(self) -> sqlite3.Connection:
+        """One long-lived connection per manager: WAL journal, autocommit, statement cache kept warm."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA cache_size=-64000')
+        if self.use_embeddings:
+            try:
+                import sqlite_vec
+                conn.enable_load_extension(True)
+                sqlite_vec.load(conn)
+                conn.enable_load_extension(False)
+            except Exception as e:
+                self.use_embeddings = False
+                logger.warning(f"sqlite-vec unavailable ({e}), using hashed-term recall", extra={'chat_id': self.chat_id})
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Lock the shared connection and wrap the block in one BEGIN IMMEDIATE/COMMIT."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            # Take the write lock up front: a deferred BEGIN that reads first fails at once with
+            # 'database is locked' if another process commits meanwhile, bypassing the busy timeout
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+                cursor.execute('COMMIT')
+            except Exception:
+                # Also covers a failed COMMIT (e.g. SQLITE_BUSY): never leave the shared connection mid-transaction
+                if self.conn.in_transaction:
+                    cursor.execute('ROLLBACK')
+                raise
+    
+    def close(self):
+        self.flush()
+        self._save_doc_matrix()
+        with self._lock:
+            self.conn.close()
+    
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Encoded memory table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS encoded_memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT,
-                timestamp REAL,
-                title TEXT,
-                encoded_data TEXT,
-                orig_tokens INTEGER
-            )
-        ''')
-        
-        # Migration for chat_id
-        cursor.execute("PRAGMA table_info(encoded_memory)")
-        columns = [row[1] for row in cursor.fetchall()]
-        if 'chat_id' not in columns:
-            cursor.execute('ALTER TABLE encoded_memory ADD COLUMN chat_id TEXT')
-            logger.info("🔧 Migrated DB: Added chat_id column", extra={'chat_id': self.chat_id})
-            conn.commit()
-        
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_timestamp ON encoded_memory(chat_id, timestamp)')
-        
-        # Chat sessions table
-        if self.enable_history:
+        with self._transaction() as cursor:
+            # Encoded memory table (encoded_data holds raw zstd bytes; a legacy TEXT-affinity column stores BLOBs as-is)
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_sessions (
-                    chat_id TEXT PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS encoded_memory (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT,
+                    timestamp REAL,
                     title TEXT,
+                    encoded_data BLOB,
+                    orig_tokens INTEGER,
+                    dict_id INTEGER
+                )
+            ''')
+            
+            # Migration for chat_id
+            cursor.execute("PRAGMA table_info(encoded_memory)")
+            columns = [row[1] for row in cursor.fetchall()]
+            if 'chat_id' not in columns:
+                cursor.execute('ALTER TABLE encoded_memory ADD COLUMN chat_id TEXT')
+                logger.info("🔧 Migrated DB: Added chat_id column", extra={'chat_id': self.chat_id})
+            
+            # Migration for embedding (FP32 sentence embedding, source for exact similarity)
+            if 'embedding' not in columns:
+                cursor.execute('ALTER TABLE encoded_memory ADD COLUMN embedding BLOB')
+                logger.info("🔧 Migrated DB: Added embedding column", extra={'chat_id': self.chat_id})
+            
+            # Migration for dict_id (zstd dictionary each frame needs, so unused dictionaries can be pruned)
+            if 'dict_id' not in columns:
+                cursor.execute('ALTER TABLE encoded_memory ADD COLUMN dict_id INTEGER')
+                cursor.execute("SELECT id, encoded_data FROM encoded_memory WHERE typeof(encoded_data) = 'blob'")
+                updates = []
+                for entry_id, data in cursor.fetchall():
+                    try:
+                        updates.append((frame_dictionary_id(data), entry_id))
+                    except ValueError as e:
+                        logger.warning(f"Memory {entry_id} has no readable zstd header: {e}", extra={'chat_id': self.chat_id})
+                cursor.executemany('UPDATE encoded_memory SET dict_id = ? WHERE id = ?', updates)
+                logger.info("🔧 Migrated DB: Added dict_id column", extra={'chat_id': self.chat_id})
+            
+            # Trained zstd dictionaries, each saved with the first row that references it
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS zstd_dicts (
+                    dict_id INTEGER PRIMARY KEY,
                     created_at REAL,
-                    last_updated REAL,
-                    preview TEXT
+                    dict_data BLOB
                 )
             ''')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_last_updated ON chat_sessions(last_updated)')
-        
-        conn.commit()
-        conn.close()
+            # Prune dictionaries no row needs any more (skipped while any frame's dictionary is unknown)
+            cursor.execute('''
+                DELETE FROM zstd_dicts
+                WHERE dict_id NOT IN (SELECT dict_id FROM encoded_memory WHERE dict_id IS NOT NULL)
+                AND NOT EXISTS (SELECT 1 FROM encoded_memory WHERE dict_id IS NULL AND typeof(encoded_data) = 'blob')
+            ''')
+            if cursor.rowcount > 0:
+                logger.info(f"Pruned {cursor.rowcount} unused zstd dictionaries", extra={'chat_id': self.chat_id})
+            # Only the newest is loaded up front (for compression); older ones load when a frame needs them
+            row = cursor.execute('SELECT dict_data FROM zstd_dicts ORDER BY created_at DESC LIMIT 1').fetchone()
+            if row:
+                register_dictionary(row[0])
+            
+            # Migration for legacy base64/LZMA rows: decode once, rewrite as raw zstd BLOBs
+            cursor.execute("SELECT id, title, encoded_data FROM encoded_memory WHERE typeof(encoded_data) = 'text'")
+            legacy_rows = cursor.fetchall()
+            if legacy_rows:
+                updates = []
+                for entry_id, title, data in legacy_rows:
+                    try:
+                        encoded = encode_text_local(decode_legacy_text(data), title)['encoded_data']
+                    except ValueError as e:
+                        # Left as-is: a corrupt row must not stop the app from starting
+                        logger.warning(f"Skipped legacy memory {entry_id}: {e}", extra={'chat_id': self.chat_id})
+                        continue
+                    updates.append((encoded, frame_dictionary_id(encoded), entry_id))
+                self._persist_dictionaries(cursor, [dict_id for _, dict_id, _ in updates])
+                cursor.executemany('UPDATE encoded_memory SET encoded_data = ?, dict_id = ? WHERE id = ?', updates)
+                logger.info(f"🔧 Migrated DB: Re-encoded {len(updates)}/{len(legacy_rows)} base64/LZMA rows as zstd BLOBs", extra={'chat_id': self.chat_id})
+            
+            # KNN index over 1-bit (sign) codes, 48 bytes per memory; rowid = encoded_memory.id
+            if self.use_embeddings:
+                cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('memory_vectors', 'memory_codes')")
+                existing = {row[0] for row in cursor.fetchall()}
+                if 'memory_codes' not in existing:
+                    cursor.execute(f'''
+                        CREATE VIRTUAL TABLE memory_codes USING vec0(
+                            chat_id TEXT partition key,
+                            embedding bit[{EMBED_DIM}]
+                        )
+                    ''')
+                    cursor.execute('''
+                        INSERT INTO memory_codes (rowid, chat_id, embedding)
+                        SELECT id, chat_id, vec_quantize_binary(embedding) FROM encoded_memory WHERE embedding IS NOT NULL
+                    ''')
+                    if 'memory_vectors' in existing:
+                        cursor.execute('DROP TABLE memory_vectors')
+                        logger.info("🔧 Migrated DB: Rebuilt int8 vector index as binary codes", extra={'chat_id': self.chat_id})
+            
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_timestamp ON encoded_memory(chat_id, timestamp)')
+            
+            # Chat sessions table
+            if self.enable_history:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS chat_sessions (
+                        chat_id TEXT PRIMARY KEY,
+                        title TEXT,
+                        created_at REAL,
+                        last_updated REAL,
+                        preview TEXT,
+                        total_tokens INTEGER DEFAULT 0
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_last_updated ON chat_sessions(last_updated)')
+                
+                # Migration for total_tokens (denormalized SUM(orig_tokens), kept incrementally)
+                cursor.execute("PRAGMA table_info(chat_sessions)")
+                if 'total_tokens' not in [row[1] for row in cursor.fetchall()]:
+                    cursor.execute('ALTER TABLE chat_sessions ADD COLUMN total_tokens INTEGER DEFAULT 0')
+                    cursor.execute('''
+                        UPDATE chat_sessions SET total_tokens = (
+                            SELECT COALESCE(SUM(orig_tokens), 0) FROM encoded_memory WHERE encoded_memory.chat_id = chat_sessions.chat_id
+                        )
+                    ''')
+                    logger.info("🔧 Migrated DB: Added total_tokens column", extra={'chat_id': self.chat_id})
         logger.info("DB initialized/migrated successfully", extra={'chat_id': self.chat_id})
     
+    def _persist_dictionaries(self, cursor: sqlite3.Cursor, dict_ids: List[int]):
+        """Save the dictionaries the given frames use, in the same transaction as the rows (a frame never outlives its dictionary)."""
+        for dict_id in set(dict_ids) - {0}:
+            if cursor.execute('SELECT 1 FROM zstd_dicts WHERE dict_id = ?', (dict_id,)).fetchone() is None:
+                cursor.execute(
+                    'INSERT INTO zstd_dicts (dict_id, created_at, dict_data) VALUES (?, ?, ?)',
+                    (dict_id, datetime.now().timestamp(), get_dictionary(dict_id))
+                )
+                logger.info(f"Persisted zstd dictionary {dict_id}", extra={'chat_id': 'GLOBAL'})
+    
+    def _decode(self, encoded_data: bytes) -> str:
+        """decode_text_local, first loading the frame's dictionary from zstd_dicts if this process has not seen it (e.g. trained by another process)."""
+        if isinstance(encoded_data, bytes):
+            dict_id = frame_dictionary_id(encoded_data)
+            if not has_dictionary(dict_id):
+                with self._lock:
+                    row = self.conn.execute('SELECT dict_data FROM zstd_dicts WHERE dict_id = ?', (dict_id,)).fetchone()
+                if row:
+                    register_dictionary(row[0], activate=False)
+        return decode_text_local(encoded_data)
+    
     def create_session(self, title: str = "New Chat") -> str:
         if not self.enable_history:
             return str(uuid4())
         if self.chat_id == 'GLOBAL':
             self.chat_id = str(uuid4())
         now = datetime.now().timestamp()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT OR IGNORE INTO chat_sessions (chat_id, title, created_at, last_updated, preview) VALUES (?, ?, ?, ?, ?)',
-            (self.chat_id, title, now, now, "Welcome to chat!")
-        )
-        conn.commit()
-        conn.close()
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO chat_sessions (chat_id, title, created_at, last_updated, preview) VALUES (?, ?, ?, ?, ?)',
+                (self.chat_id, title, now, now, "Welcome to chat!")
+            )
         logger.info(f"Created session: {self.chat_id} - {title}", extra={'chat_id': self.chat_id})
         return self.chat_id
     
@@ -121,66 +365,109 @@ class SimpleMemoryManager:
         if not self.enable_history:
             return
         now = datetime.now().timestamp()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE chat_sessions SET title = ?, last_updated = ?, preview = ? WHERE chat_id = ?',
-            (title, now, preview, self.chat_id)
-        )
-        conn.commit()
-        conn.close()
+        with self._lock:
+            self.conn.execute(
+                'UPDATE chat_sessions SET title = ?, last_updated = ?, preview = ? WHERE chat_id = ?',
+                (title, now, preview, self.chat_id)
+            )
         logger.info(f"Updated session {self.chat_id}: {title}", extra={'chat_id': self.chat_id})
     
     def get_sessions(self) -> List[dict]:
         if not self.enable_history:
             return []
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT chat_id, title, created_at, last_updated, preview FROM chat_sessions ORDER BY last_updated DESC')
-        rows = cursor.fetchall()
-        conn.close()
+        self.flush()  # Titles, previews and totals are written by the flush thread
+        with self._lock:
+            rows = self.conn.execute('SELECT chat_id, title, created_at, last_updated, preview, total_tokens FROM chat_sessions ORDER BY last_updated DESC').fetchall()
         return [
-            {'id': r[0], 'title': r[1], 'created': datetime.fromtimestamp(r[2]), 'updated': datetime.fromtimestamp(r[3]), 'preview': r[4]}
+            {'id': r[0], 'title': r[1], 'created': datetime.fromtimestamp(r[2]), 'updated': datetime.fromtimestamp(r[3]), 'preview': r[4], 'tokens': r[5] or 0}
             for r in rows
         ]
     
     def get_session_history(self, chat_id: str) -> List[dict]:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT title, orig_tokens, timestamp FROM encoded_memory 
-            WHERE chat_id = ? ORDER BY timestamp ASC
-        ''', (chat_id,))
-        rows = cursor.fetchall()
-        conn.close()
+        self.flush()
+        with self._lock:
+            rows = self.conn.execute('''
+                SELECT title, orig_tokens, timestamp FROM encoded_memory 
+                WHERE chat_id = ? ORDER BY timestamp ASC
+            ''', (chat_id,)).fetchall()
         return [{'title': r[0], 'tokens': r[1], 'time': datetime.fromtimestamp(r[2])} for r in rows]
     
     def delete_session(self, chat_id: str):
         if not self.enable_history:
             return
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM encoded_memory WHERE chat_id = ?', (chat_id,))
-        conn.commit()
-        conn.close()
+        self.flush()
+        with self._transaction() as cursor:
+            if self.use_embeddings:
+                cursor.execute('DELETE FROM memory_codes WHERE rowid IN (SELECT id FROM encoded_memory WHERE chat_id = ?)', (chat_id,))
+            cursor.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM encoded_memory WHERE chat_id = ?', (chat_id,))
+        self._decoded_cache.pop(chat_id, None)
+        self._seen_hashes.pop(chat_id, None)
+        for path in (self._doc_matrix_path(chat_id), self._doc_ids_path(chat_id)):
+            if os.path.exists(path):
+                os.remove(path)
         logger.info(f"Deleted session {chat_id}", extra={'chat_id': 'GLOBAL'})
     
     def get_stored_tokens_for_session(self, chat_id: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT SUM(orig_tokens) FROM encoded_memory WHERE chat_id = ?', (chat_id,))
-        total = cursor.fetchone()[0] or 0
-        conn.close()
-        return int(total)
-    
-    def _get_stored_raw(self, chat_id: str) -> List[tuple]:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT encoded_data FROM encoded_memory WHERE chat_id = ? ORDER BY timestamp ASC', (chat_id,))
-        raw_rows = cursor.fetchall()
-        conn.close()
-        return [(row[0], decode_text_local(row[0])) for row in raw_rows]
+        self.flush()
+        with self._lock:
+            if self.enable_history:
+                row = self.conn.execute('SELECT total_tokens FROM chat_sessions WHERE chat_id = ?', (chat_id,)).fetchone()
+            else:
+                row = self.conn.execute('SELECT SUM(orig_tokens) FROM encoded_memory WHERE chat_id = ?', (chat_id,)).fetchone()
+        return int(row[0] or 0) if row else 0
+    
+    def _get_stored_raw(self, chat_id: str, limit: Optional[int] = None) -> List[tuple]:
+        self.flush()
+        with self._lock:
+            if limit is None:
+                raw_rows = self.conn.execute('SELECT encoded_data FROM encoded_memory WHERE chat_id = ? ORDER BY timestamp ASC', (chat_id,)).fetchall()
+            else:
+                raw_rows = self.conn.execute('SELECT encoded_data FROM encoded_memory WHERE chat_id = ? ORDER BY timestamp DESC LIMIT ?', (chat_id, limit)).fetchall()[::-1]
+        decoded = []
+        for (data,) in raw_rows:
+            try:
+                decoded.append((data, self._decode(data)))
+            except ValueError as e:
+                logger.warning(f"Skipped unreadable memory: {e}", extra={'chat_id': chat_id})
+        return decoded
+    
+    def _decoded_for(self, chat_id: str) -> 'OrderedDict[int, str]':
+        """
+        Decoded texts of a chat by memory id (last RECALL_WINDOW, oldest first). The id list comes
+        from the index on every call; only rows not decoded before are fetched and decompressed.
+        """
+        self.flush()
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT id FROM encoded_memory WHERE chat_id = ? ORDER BY timestamp DESC LIMIT ?', (chat_id, RECALL_WINDOW)
+            ).fetchall()
+        ids = [row[0] for row in reversed(rows)]
+        cached = self._decoded_cache.get(chat_id, {})
+        missing = [entry_id for entry_id in ids if entry_id not in cached]
+        fresh = {}
+        if missing:
+            with self._lock:
+                fresh = dict(self.conn.execute(
+                    f"SELECT id, encoded_data FROM encoded_memory WHERE id IN ({','.join('?' * len(missing))})", missing
+                ).fetchall())
+            for entry_id, data in fresh.items():
+                try:
+                    fresh[entry_id] = self._decode(data)
+                except ValueError as e:
+                    fresh[entry_id] = None  # Cached as unreadable so it is only reported once
+                    logger.warning(f"Skipped unreadable memory {entry_id}: {e}", extra={'chat_id': chat_id})
+        texts = OrderedDict((entry_id, cached[entry_id] if entry_id in cached else fresh.get(entry_id)) for entry_id in ids)
+        self._decoded_cache[chat_id] = texts
+        self._decoded_cache.move_to_end(chat_id)
+        if len(self._decoded_cache) > DECODED_CACHE_SIZE:
+            self._decoded_cache.popitem(last=False)
+        return texts
+    
+    @property
+    def stored_texts(self) -> List[str]:
+        """Current chat's memories, decoded lazily on first use (only the hashed-term recall needs them)."""
+        return [text for text in self._decoded_for(self.chat_id).values() if text is not None]
     
     def _grade_response(self, response):
         if not self.use_grader:
@@ -189,7 +476,41 @@ class SimpleMemoryManager:
         keyword_score = 5 if any(word in response.lower() for word in ['explain', 'detail', 'example']) else 3
         return (length_score + keyword_score) // 2
         
-    def store_response(self, response: str, title: str, first_prompt: str = None, tokens: int = None):
+    def register_user_turn(self, text: str):
+        """Add text entering the prompt (user turn or injected context) to current_tokens; counted lazily."""
+        self._uncounted.append(text)
+    
+    def register_model_turn(self, text: str, usage=None):
+        """
+        Account for a Gemini reply. With the response's usage_metadata the prompt + reply size is
+        exact and nothing pending needs a count_tokens call; without it (API error) the text is counted lazily.
+        """
+        prompt_tokens = getattr(usage, 'prompt_token_count', None)
+        if prompt_tokens:
+            self._counted_tokens = prompt_tokens + (getattr(usage, 'candidates_token_count', None) or 0)
+            self._uncounted = []
+        else:
+            self._uncounted.append(text)
+    
+    @property
+    def current_tokens(self) -> int:
+        """Running prompt size in Gemini tokens; at most one count_tokens call covers everything added since the last reply."""
+        if self._uncounted:
+            self._counted_tokens += self._count_tokens(self._uncounted)
+            self._uncounted = []
+        return self._counted_tokens
+    
+    def _count_tokens(self, texts: List[str]) -> int:
+        """Gemini tokenizer count for several messages in one request."""
+        try:
+            return model.count_tokens(texts).total_tokens
+        except Exception as e:
+            count = sum(len(text) for text in texts) // 3  # Offline/API error: ~3 chars per token
+            logger.debug(f"count_tokens failed ({e}), estimating {count} tokens", extra={'chat_id': self.chat_id})
+            return count
+    
+    def store_response(self, response: str, title: str, first_prompt: str = None, tokens: int = None) -> bool:
+        """Queue a reply for storage; False when it was skipped (short, duplicate, low grade, incompressible)."""
         if first_prompt:
             self.first_prompt = first_prompt
         
@@ -199,56 +520,310 @@ class SimpleMemoryManager:
         if tokens < self.min_tokens_threshold:
             self.metrics['skipped_short'] += 1
             logger.info(f"Skipped short response '{title[:30]}...': {tokens} tokens (< {self.min_tokens_threshold})", extra={'chat_id': self.chat_id})
-            return
+            return False
+        
+        # Exact repeat of a recent reply in this chat (greetings, clarifications, stack traces)
+        digest = xxhash.xxh3_64_intdigest(response.encode('utf-8'))
+        if digest in self._seen_hashes[self.chat_id]:
+            self.metrics['skipped_dup'] += 1
+            logger.info(f"Skipped duplicate response '{title[:30]}...'", extra={'chat_id': self.chat_id})
+            return False
         
         score = self._grade_response(response)
         if score < self.grade_threshold:
             self.metrics['skipped_low_grade'] += 1
             logger.info(f"Skipped low-grade response '{title[:30]}...': Score {score}/10", extra={'chat_id': self.chat_id})
-            return
+            return False
         
         # Auto-title on first store
         if self.first_prompt and 'New Chat' in title:
             auto_title = f"Chat about {self.first_prompt[:30].replace(' ', '_')}"
             self.update_session(auto_title, f"Started with: {self.first_prompt[:50]}...")
         
-        encoded_dict = encode_text_local(response, title)
+        # Compress up front (cheap with the shared zstd context) so incompressible replies never reach the queue
+        encoded = encode_text_local(response, title)['encoded_data']
         orig_chars = len(response.encode('utf-8'))
-        self.metrics['total_compressed_chars'] += orig_chars - len(encoded_dict['encoded_data'])
+        if len(encoded) > MIN_COMPRESSION_GAIN * orig_chars:
+            self.metrics['skipped_incompressible'] += 1
+            logger.info(f"Skipped incompressible response '{title[:30]}...': {len(encoded)}/{orig_chars} bytes", extra={'chat_id': self.chat_id})
+            return False
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO encoded_memory (chat_id, timestamp, title, encoded_data, orig_tokens) VALUES (?, ?, ?, ?, ?)',
-            (self.chat_id, datetime.now().timestamp(), title, encoded_dict['encoded_data'], tokens)
-        )
-        conn.commit()
-        conn.close()
-        self.metrics['stores'] += 1
-        ratio = orig_chars / len(encoded_dict['encoded_data']) if encoded_dict['encoded_data'] else 1
-        logger.info(f"Stored '{title[:30]}...': {tokens} tokens (Grade: {score}/10) → {len(encoded_dict['encoded_data'])} chars ({ratio:.1f}x savings!)", extra={'chat_id': self.chat_id})
+        # Embedding and the INSERT happen on the flush thread; the UI only pays for the enqueue.
+        # Only replies that are actually stored count as seen, so a rejected one can retry later.
+        self._seen_hashes[self.chat_id].append(digest)
+        self._write_q.put({
+            'chat_id': self.chat_id, 'timestamp': datetime.now().timestamp(), 'title': title,
+            'response': response, 'encoded': encoded, 'tokens': tokens, 'score': score,
+            'preview': f"Last: {response[:50]}...", 'digest': digest,
+        })
+        return True
+    
+    def _flush_loop(self):
+        """Drain the write queue into one executemany + COMMIT per FLUSH_INTERVAL window (or FLUSH_BATCH items)."""
+        while True:
+            batch = [self._write_q.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < FLUSH_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._write_q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self._write_q.task_done()
+    
+    def _write_batch_with_retry(self, batch: List[dict]):
+        """Retry lock contention / transient I/O errors with backoff; drop the batch only once they persist."""
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                self._write_batch(batch)
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == WRITE_RETRIES:
+                    logger.error(f"Failed to write {len(batch)} memories after {attempt} attempts: {e}", extra={'chat_id': batch[0]['chat_id']})
+                    break
+                logger.warning(f"Write of {len(batch)} memories failed ({e}), retrying", extra={'chat_id': batch[0]['chat_id']})
+                time.sleep(0.1 * 2 ** attempt)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} memories: {e}", extra={'chat_id': batch[0]['chat_id']})
+                break
+        self._discard_batch(batch)
+    
+    def _write_batch(self, batch: List[dict]):
+        rows = []
+        previews = {}  # chat_id -> (title, preview) of its latest item
+        added_tokens = {}  # chat_id -> tokens stored in this batch
+        for item in batch:
+            encoded = item['encoded']
+            if 'embedding' not in item:  # Kept on the item so a retried batch is not re-embedded
+                try:
+                    item['embedding'] = self._embed(item['response'])
+                except Exception as e:
+                    # Stored without it; _backfill_embeddings retries on the chat's next recall
+                    item['embedding'] = None
+                    self._embedded_chats.discard(item['chat_id'])
+                    logger.warning(f"Embedding failed for '{item['title'][:30]}...': {e}, storing without it", extra={'chat_id': item['chat_id']})
+            embedding = item['embedding']
+            rows.append((item['chat_id'], item['timestamp'], item['title'], encoded, item['tokens'],
+                         embedding.tobytes() if embedding is not None else None, frame_dictionary_id(encoded)))
+            previews[item['chat_id']] = (item['title'], item['preview'])
+            added_tokens[item['chat_id']] = added_tokens.get(item['chat_id'], 0) + item['tokens']
         
-        # Update session preview
-        if self.enable_history:
-            preview = f"Last: {response[:50]}..."
-            self.update_session(title if 'New Chat' not in title else title, preview)
+        now = datetime.now().timestamp()
+        with self._transaction() as cursor:
+            last_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM encoded_memory').fetchone()[0]
+            self._persist_dictionaries(cursor, [row[6] for row in rows])
+            cursor.executemany(
+                'INSERT INTO encoded_memory (chat_id, timestamp, title, encoded_data, orig_tokens, embedding, dict_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            if self.use_embeddings:
+                # BEGIN IMMEDIATE holds the write lock since last_id was read, so everything past it is this batch
+                cursor.execute('''
+                    INSERT INTO memory_codes (rowid, chat_id, embedding)
+                    SELECT id, chat_id, vec_quantize_binary(embedding) FROM encoded_memory WHERE id > ? AND embedding IS NOT NULL
+                ''', (last_id,))
+            # Update session previews + running token totals
+            if self.enable_history:
+                cursor.executemany(
+                    'UPDATE chat_sessions SET title = ?, last_updated = ?, preview = ?, total_tokens = total_tokens + ? WHERE chat_id = ?',
+                    [(title, now, preview, added_tokens[chat_id], chat_id) for chat_id, (title, preview) in previews.items()]
+                )
         
-        # Cache for semantic
-        self.stored_texts.append((self.chat_id, response))
+        # Counted only once the rows are committed
+        for item in batch:
+            encoded = item['encoded']
+            orig_chars = len(item['response'].encode('utf-8'))
+            self.metrics['stores'] += 1
+            self.metrics['total_compressed_chars'] += orig_chars - len(encoded)
+            ratio = orig_chars / len(encoded) if encoded else 1
+            logger.info(f"Stored '{item['title'][:30]}...': {item['tokens']} tokens (Grade: {item['score']}/10) → {len(encoded)} bytes ({ratio:.1f}x savings!)", extra={'chat_id': item['chat_id']})
     
-    def find_relevant(self, query: str, top_k: int = 2, min_sim: float = 0.3) -> List[str]:
-        chat_texts = [text for cid, text in self.stored_texts if cid == self.chat_id]
-        if len(chat_texts) < 2:
-            logger.debug(f"No texts for semantic recall in chat {self.chat_id}", extra={'chat_id': self.chat_id})
+    def _discard_batch(self, batch: List[dict]):
+        """Undo store_response's in-memory bookkeeping for items that never reached the DB."""
+        for item in batch:
+            try:
+                self._seen_hashes[item['chat_id']].remove(item['digest'])
+            except ValueError:
+                pass
+    
+    def flush(self):
+        """Block until every queued store has been committed."""
+        self._write_q.join()
+    
+    @property
+    def vectorizer(self):
+        """HashingVectorizer for the fallback recall; sklearn is imported on first use."""
+        if self._vectorizer is None:
+            from sklearn.feature_extraction.text import HashingVectorizer
+            self._vectorizer = HashingVectorizer(n_features=4096, alternate_sign=False, norm='l2')
+        return self._vectorizer
+    
+    def _embed(self, text: str) -> Optional['np.ndarray']:
+        """Normalized FP32 sentence embedding, or None when running without the embedding stack."""
+        if not self.use_embeddings:
+            return None
+        if self.embedder is None:
+            self.embedder = load_embedder()
+            if self.embedder is None:
+                self.use_embeddings = False
+                return None
+        import numpy as np
+        return self.embedder.encode(text, normalize_embeddings=True).astype(np.float32)
+    
+    def _doc_matrix_path(self, chat_id: str) -> str:
+        return os.path.join(self.vectors_dir, f"{chat_id}.npz")
+    
+    def _doc_ids_path(self, chat_id: str) -> str:
+        return os.path.join(self.vectors_dir, f"{chat_id}.ids.npy")
+    
+    def _load_doc_matrix(self, chat_id: str) -> tuple:
+        """(matrix, memory ids of its rows), or (None, []) when nothing usable is on disk."""
+        path = self._doc_matrix_path(chat_id)
+        if not (os.path.exists(path) and os.path.exists(self._doc_ids_path(chat_id))):
+            return None, []
+        try:
+            import numpy as np
+            import scipy.sparse as sp
+            matrix = sp.load_npz(path).tocsr()
+            ids = np.load(self._doc_ids_path(chat_id)).tolist()
+            if len(ids) != matrix.shape[0]:
+                raise ValueError(f"{len(ids)} ids for {matrix.shape[0]} rows")
+            return matrix, ids
+        except Exception as e:
+            logger.warning(f"Could not load vectors from {path}: {e}, will rebuild", extra={'chat_id': chat_id})
+            return None, []
+    
+    def _align_doc_matrix(self, texts: 'OrderedDict[int, str]'):
+        """Re-index doc_matrix onto the given memories: rows of known ids are reused, only new ones are vectorized."""
+        import scipy.sparse as sp
+        ids = list(texts)
+        rows = {entry_id: row for row, entry_id in enumerate(self.doc_ids)}
+        new_ids = [entry_id for entry_id in ids if entry_id not in rows]
+        matrix = self.doc_matrix
+        if new_ids:
+            vectors = self.vectorizer.transform([texts[entry_id] for entry_id in new_ids])
+            offset = matrix.shape[0] if matrix is not None else 0
+            rows.update((entry_id, offset + k) for k, entry_id in enumerate(new_ids))
+            matrix = vectors if matrix is None else sp.vstack([matrix, vectors], format='csr')
+        self.doc_matrix = matrix[[rows[entry_id] for entry_id in ids]]
+        self.doc_ids = ids
+        self._doc_matrix_dirty = True
+    
+    def _drop_doc_rows(self, evicted: set):
+        """Remove evicted memories from doc_matrix so the saved .npz never outlives their rows."""
+        keep = [row for row, entry_id in enumerate(self.doc_ids) if entry_id not in evicted]
+        if len(keep) == len(self.doc_ids):
+            return
+        self.doc_matrix = self.doc_matrix[keep] if keep else None
+        self.doc_ids = [self.doc_ids[row] for row in keep]
+        self._doc_matrix_dirty = True
+        if self.doc_matrix is None:
+            for path in (self._doc_matrix_path(self.chat_id), self._doc_ids_path(self.chat_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def _save_doc_matrix(self):
+        if not self._doc_matrix_dirty or self.doc_matrix is None:
+            return
+        try:
+            import numpy as np
+            import scipy.sparse as sp
+            os.makedirs(self.vectors_dir, exist_ok=True)
+            sp.save_npz(self._doc_matrix_path(self.chat_id), self.doc_matrix)
+            np.save(self._doc_ids_path(self.chat_id), np.asarray(self.doc_ids, dtype=np.int64))
+            self._doc_matrix_dirty = False
+        except Exception as e:
+            logger.warning(f"Could not save vectors for {self.chat_id}: {e}", extra={'chat_id': self.chat_id})
+    
+    def _backfill_embeddings(self, chat_id: str):
+        """Embed and index rows stored before the embedding stack was available (upgraded DBs, failed embeds)."""
+        with self._lock:
+            rows = self.conn.execute('SELECT id, encoded_data FROM encoded_memory WHERE chat_id = ? AND embedding IS NULL', (chat_id,)).fetchall()
+        updates = []
+        for entry_id, data in rows:
+            try:
+                embedding = self._embed(self._decode(data))
+            except Exception as e:
+                logger.warning(f"Could not embed memory {entry_id}: {e}", extra={'chat_id': chat_id})
+                continue
+            if embedding is None:
+                return
+            updates.append((embedding.tobytes(), entry_id))
+        if updates:
+            with self._transaction() as cursor:
+                cursor.executemany('UPDATE encoded_memory SET embedding = ? WHERE id = ?', updates)
+                cursor.executemany('''
+                    INSERT INTO memory_codes (rowid, chat_id, embedding)
+                    SELECT id, chat_id, vec_quantize_binary(embedding) FROM encoded_memory WHERE id = ?
+                ''', [(entry_id,) for _, entry_id in updates])
+            logger.info(f"Backfilled embeddings for {len(updates)} memories", extra={'chat_id': chat_id})
+        self._embedded_chats.add(chat_id)
+    
+    def _find_relevant_semantic(self, query: str, query_emb: 'np.ndarray', top_k: int, min_sim: float) -> List[str]:
+        import numpy as np
+        self.flush()
+        if self.chat_id not in self._embedded_chats:
+            self._backfill_embeddings(self.chat_id)
+        with self._lock:
+            cursor = self.conn.cursor()
+            # Coarse pass: Hamming distance over sign bits (popcount in sqlite-vec)
+            cursor.execute('''
+                SELECT rowid FROM memory_codes
+                WHERE embedding MATCH vec_quantize_binary(?) AND chat_id = ? AND k = ?
+                ORDER BY distance
+            ''', (query_emb.tobytes(), self.chat_id, max(RERANK_CANDIDATES, top_k)))
+            ids = [row[0] for row in cursor.fetchall()]
+            rows = []
+            if ids:
+                cursor.execute(f"SELECT id, embedding FROM encoded_memory WHERE id IN ({','.join('?' * len(ids))})", ids)
+                rows = cursor.fetchall()
+        if not rows:
+            self.metrics['semantic_recalls'] += 1
             return []
+        # Rerank: exact cosine on the FP32 vectors of the candidates only
+        cand_ids = [row[0] for row in rows]
+        embs = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), EMBED_DIM)
+        sims = embs @ query_emb
+        order = _top_k(sims, top_k, min_sim)
+        relevant = []
+        if len(order):
+            keep = [cand_ids[i] for i in order]
+            with self._lock:
+                by_id = dict(self.conn.execute(f"SELECT id, encoded_data FROM encoded_memory WHERE id IN ({','.join('?' * len(keep))})", keep).fetchall())
+            relevant = [self._decode(by_id[entry_id]) for entry_id in keep]
+        self.metrics['semantic_recalls'] += 1
+        logger.info(f"Found {len(relevant)} relevant memories for '{query[:30]}...' from {len(ids)} candidates (top sims: {sims[order]})", extra={'chat_id': self.chat_id})
+        return relevant
+    
+    def find_relevant(self, query: str, top_k: int = 2, min_sim: float = 0.3) -> List[str]:
+        query_emb = self._embed(query)
+        if query_emb is not None:
+            try:
+                return self._find_relevant_semantic(query, query_emb, top_k, min_sim)
+            except Exception as e:
+                logger.warning(f"Embedding recall failed: {e}, falling back to hashed terms", extra={'chat_id': self.chat_id})
         
         try:
-            vectors = self.vectorizer.fit_transform(chat_texts + [query])
-            sims = cosine_similarity(vectors[-1:], vectors[:-1])[0]
-            top_idx = np.argsort(sims)[-top_k:][::-1]
-            relevant = [chat_texts[i] for i in top_idx if sims[i] >= min_sim]
+            texts = OrderedDict((entry_id, text) for entry_id, text in self._decoded_for(self.chat_id).items() if text is not None)
+            if len(texts) < 2:
+                logger.debug(f"No texts for semantic recall in chat {self.chat_id}", extra={'chat_id': self.chat_id})
+                return []
+            
+            # Rows are matched to memories by id: new stores, reabsorbs and resumes only touch the rows that changed
+            if self.doc_ids != list(texts):
+                self._align_doc_matrix(texts)
+            query_vec = self.vectorizer.transform([query])
+            sims = (self.doc_matrix @ query_vec.T).toarray().ravel()  # Rows are L2-normalized: dot == cosine
+            top_idx = _top_k(sims, top_k, min_sim)
+            relevant = [texts[self.doc_ids[i]] for i in top_idx]
             self.metrics['semantic_recalls'] += 1
-            logger.info(f"Found {len(relevant)} relevant memories for '{query[:30]}...' (top sims: {sims[top_idx[:len(relevant)]]})", extra={'chat_id': self.chat_id})
+            logger.info(f"Found {len(relevant)} relevant memories for '{query[:30]}...' (top sims: {sims[top_idx]})", extra={'chat_id': self.chat_id})
             return relevant
         except Exception as e:
             logger.warning(f"Semantic recall failed: {e}, fallback to []", extra={'chat_id': self.chat_id})
@@ -259,57 +834,68 @@ class SimpleMemoryManager:
         high_usage = current_tokens > self.token_limit * 0.8
         on_interval = self.turn_counter % self.reabsorb_interval == 0
         decision = high_usage or on_interval
+        # Interval turns bring back one memory; only token pressure evicts a batch
+        self.reabsorb_batch = REABSORB_BATCH if high_usage else 1
         logger.debug(f"Reabsorb check: Turn {self.turn_counter}, usage {current_tokens}/{self.token_limit}, decision: {decision}", extra={'chat_id': self.chat_id})
         return decision
     
-    def reabsorb_oldest(self) -> str:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, encoded_data, orig_tokens FROM encoded_memory 
-            WHERE chat_id = ? ORDER BY timestamp ASC LIMIT 1
-        ''', (self.chat_id,))
-        row = cursor.fetchone()
-        if row:
-            entry_id, encoded_data, tokens = row
-            reabsorbed = decode_text_local(encoded_data)
-            cursor.execute('DELETE FROM encoded_memory WHERE id = ? AND chat_id = ?', (entry_id, self.chat_id))
-            conn.commit()
-            conn.close()
-            self.metrics['reabsorbs'] += 1
-            self.metrics['evictions'] += 1
-            logger.info(f"Reabsorbed {tokens} tokens from oldest (chat {self.chat_id}): '{reabsorbed[:50]}...'", extra={'chat_id': self.chat_id})
-            return reabsorbed
-        conn.close()
-        logger.debug(f"No memories to reabsorb for chat {self.chat_id}", extra={'chat_id': self.chat_id})
-        return ""
+    def reabsorb_oldest(self, n: int = 1) -> str:
+        """Evict the n oldest memories of this chat in one DELETE ... RETURNING and return their texts joined."""
+        self.flush()
+        texts = []
+        with self._transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM encoded_memory WHERE id IN (
+                    SELECT id FROM encoded_memory WHERE chat_id = ? ORDER BY timestamp ASC LIMIT ?
+                ) RETURNING id, timestamp, encoded_data, orig_tokens
+            ''', (self.chat_id, n))
+            rows = sorted(cursor.fetchall(), key=lambda r: r[1])  # RETURNING order is unspecified
+            for entry_id, _, data, _ in rows:
+                # Decoded before COMMIT so the rows are never gone unread. An undecodable row is
+                # still evicted: kept, it would stay the oldest and block every later reabsorb.
+                try:
+                    texts.append(self._decode(data))
+                except ValueError as e:
+                    logger.warning(f"Dropped unreadable memory {entry_id} on reabsorb: {e}", extra={'chat_id': self.chat_id})
+            if rows:
+                if self.use_embeddings:
+                    cursor.executemany('DELETE FROM memory_codes WHERE rowid = ?', [(r[0],) for r in rows])
+                if self.enable_history:
+                    cursor.execute('UPDATE chat_sessions SET total_tokens = total_tokens - ? WHERE chat_id = ?', (sum(r[3] for r in rows), self.chat_id))
+        reabsorbed = "\n".join(texts)
+        if not rows:
+            logger.debug(f"No memories to reabsorb for chat {self.chat_id}", extra={'chat_id': self.chat_id})
+            return ""
+        self._decoded_cache.pop(self.chat_id, None)
+        self._drop_doc_rows({r[0] for r in rows})
+        # Evicted replies are no longer stored, so a repeat may be stored again
+        seen = self._seen_hashes[self.chat_id]
+        for text in texts:
+            try:
+                seen.remove(xxhash.xxh3_64_intdigest(text.encode('utf-8')))
+            except ValueError:
+                pass
+        self.metrics['reabsorbs'] += 1
+        self.metrics['evictions'] += len(rows)
+        logger.info(f"Reabsorbed {len(rows)} memories / {sum(r[3] for r in rows)} tokens from oldest (chat {self.chat_id}): '{reabsorbed[:50]}...'", extra={'chat_id': self.chat_id})
+        return reabsorbed
     
     def get_stored_tokens(self) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT SUM(orig_tokens) FROM encoded_memory WHERE chat_id = ?', (self.chat_id,))
-        total = cursor.fetchone()[0] or 0
-        conn.close()
-        return int(total)
-    
-    def print_summary(self):
+        return self.get_stored_tokens_for_session(self.chat_id)
+    
+    def print_summary(self) -> Future:
         total_tokens = self.get_stored_tokens()
         expansion = total_tokens / self.token_limit if total_tokens else 1
-        skips = self.metrics['skipped_short'] + self.metrics['skipped_low_grade']
+        skips = (self.metrics['skipped_short'] + self.metrics['skipped_low_grade']
+                 + self.metrics['skipped_dup'] + self.metrics['skipped_incompressible'])
         
         logger.info(f"Session summary for {self.chat_id}: {self.metrics['stores']} stores ({skips} skipped), {self.metrics['reabsorbs']} reabsorbs, {self.metrics['semantic_recalls']} recalls, {expansion:.1f}x expansion! Saved {self.metrics['total_compressed_chars']} chars.", extra={'chat_id': self.chat_id})
         print(f"\n🎉 Chat {self.chat_id[:8]}... Metrics: {self.metrics['stores']} stores ({skips} skipped), {self.metrics['reabsorbs']} reabsorbs, {self.metrics['semantic_recalls']} recalls, {expansion:.1f}x expansion! Saved {self.metrics['total_compressed_chars']} chars.")
         
-        # Viz: Bar chart
-        fig, ax = plt.subplots(figsize=(8, 5))
+        # Viz: Bar chart (rasterized off the request path)
         metrics = ['Stores', 'Skips', 'Reabsorbs', 'Recalls', 'Expansion (x)']
         values = [self.metrics['stores'], skips, self.metrics['reabsorbs'], self.metrics['semantic_recalls'], expansion]
-        ax.bar(metrics, values, color=['blue', 'orange', 'green', 'purple', 'red'])
-        ax.set_title(f"Chat {self.chat_id[:8]}... Impact")
-        ax.set_ylabel('Value')
-        plt.xticks(rotation=45)
         chart_path = f'metrics_{self.chat_id[:8]}.png'
-        plt.savefig(chart_path)
-        plt.close()
-        logger.info(f"Metrics chart saved to {chart_path}", extra={'chat_id': self.chat_id})
-        print(f"📊 Chart saved: {chart_path}")
\ No newline at end of file
+        future = _chart_executor.submit(_render_chart, self.chat_id, metrics, values, chart_path)
+        print(f"📊 Chart queued: {chart_path}")
+        return future
\ No newline at end of file